@@ -10,6 +10,10 @@ many environments. The environment variable 'IS_DEVELOPMENT' should be set
 when running locally. This turns on logging, opens PORT + 1000, and ensures
 the use of a localhost SSL certificate.
 
+When running locally, the audio sent by each client is recorded to a wav file
+in 'recordings'.  Set the environment variable 'DUMP_RAW' to also write the
+raw PCM data to a separate file.
+
 It also exposes a simple HTTPS server for serving the client and providing status.
 
 Routes:
@@ -20,22 +24,32 @@ Routes:
 
 from __future__ import absolute_import
 
-import itertools
-import json
+import audioop
+import collections
 import logging
 import os
+import ssl
 import sys
 import time
 import wave
+from json.encoder import encode_basestring_ascii
 import transcriber
 from tornado import ioloop
 from tornado import web
 from tornado import websocket
 
+# Use ujson for parsing the config if it is installed.
+try:
+  import ujson as _json
+except ImportError:
+  import json as _json
+
 
-# Map of currently connected clients.
-_clients = {}
-_id_counter = itertools.count()
+# Whether running in a local development environment, set once at startup
+_IS_DEV = 'IS_DEVELOPMENT' in os.environ
+
+# Set of currently connected clients.
+_clients = set()
 
 # Timeout in which connection is automatically closed
 TIMEOUT = 60
@@ -46,6 +60,32 @@ PORT = 443
 # Path to test HTML client file
 CLIENT_PATH = 'client.html'
 
+# Largest websocket message accepted from a client, well above the size of
+# a chunk of real-time audio
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# Chunks of LINEAR16 audio with an RMS level below this are silent, and are
+# not sent to the Speech API.  0 disables the check, so all audio is sent.
+# Other encodings are always sent, since their chunks can't be measured or
+# dropped without corrupting the stream.
+SILENCE_THRESHOLD = 0
+
+# While the audio is silent, one silent chunk is still sent this often.  The
+# Speech API ends a stream that receives no audio for a while, so silence
+# can't be skipped entirely.
+SILENCE_KEEPALIVE_SECS = 1
+
+# Ciphers allowed for HTTPS/WSS connections.  AES-GCM is hardware accelerated
+# on most CPUs, which matters since most traffic is small audio frames.
+SSL_CIPHERS = 'ECDHE+AESGCM'
+
+# Interval in milliseconds at which queued results are sent to the client
+FLUSH_INTERVAL_MS = 30
+
+# JSON template for a transcribed result, filled with the escaped text and
+# 'true' or 'false' for isFinal.  This avoids building and encoding a dict.
+RESULT_TEMPLATE = '{"text":%s,"isFinal":%s}'
+
 
 class SpeechHandler(websocket.WebSocketHandler):
   """A streaming speech handler for a websocket client.
@@ -63,7 +103,9 @@ class SpeechHandler(websocket.WebSocketHandler):
       "punctuation": true
     }
 
-    Audio data should be relayed in real-time, as Int16 arrays.
+    Audio data should be relayed in real-time, as Int16 arrays, in messages of
+    at most MAX_MESSAGE_SIZE bytes.  Compression (permessage-deflate) is not
+    supported, since PCM audio does not compress well.
     See "tests/test.html" for a sample client implementation.
 
   Attributes:
@@ -71,6 +113,8 @@ class SpeechHandler(websocket.WebSocketHandler):
         connecting to Speech API, and transcribing audio data.
   """
 
+  max_message_size = MAX_MESSAGE_SIZE
+
   def __init__(self, application, request, **kwargs):
     super(SpeechHandler, self).__init__(application, request, **kwargs)
     logging.info('Client Created')
@@ -80,28 +124,40 @@ class SpeechHandler(websocket.WebSocketHandler):
         on_transcribed=self.on_transcribed,
         on_transcribing=self.on_transcribing)
 
-    # Create a unique id for the handler
-    self._id = _id_counter.next()
+    # A unique id for the handler, used for naming recordings
+    self._id = id(self)
+
+    # Handle for the timeout, set once transcription is started
+    self._timeout_handle = None
 
-    # Used for checking the timeout
-    self._start_time = None
+    # Whether silent audio is skipped, and when a silent chunk was last sent
+    self._skip_silence = False
+    self._silence_sent_time = 0
 
-    # Used for for the _log_stream method
-    self._log_columns = 0
+    # Characters not yet written by the _log_stream method
+    self._log_line = ''
 
     # Debug: Record audio files locally
-    self._recorded_audio_data = []
+    self._is_local = False
+    self._recorded_audio_data = bytearray()
 
-  @property
-  def id(self):
-    """Returns a unique id for the client."""
-    return self._id
+    # Outgoing JSON encoded results, sent to the client in batches by _flush
+    self._out_queue = collections.deque()
+    self._flush_cb = None
+    self._io_loop = None
 
   def open(self):
-    """Saves client id after websocket is opened."""
+    """Saves client and starts flushing results once websocket is opened."""
     logging.info('Client Connected')
-    if self.id not in _clients:
-      _clients[self.id] = self
+    _clients.add(self)
+
+    # Audio is recorded when running locally.
+    self._is_local = self.request.host == 'localhost:%i' % get_port()
+
+    # Periodically send any queued results as a single message.
+    self._io_loop = ioloop.IOLoop.current()
+    self._flush_cb = ioloop.PeriodicCallback(self._flush, FLUSH_INTERVAL_MS)
+    self._flush_cb.start()
 
   def on_message(self, data):
     """Handles an incoming websocket message from the client.
@@ -112,32 +168,38 @@ class SpeechHandler(websocket.WebSocketHandler):
           audio data.
     """
 
-    # Check for timeout.
-    if self._start_time and self.transcriber.is_started:
-      now = time.time()
-      if (now - self._start_time).total_seconds() > TIMEOUT:
-        logging.info('Timeout... Closing socket')
-        self.close()
-        return
-
     # Config, set by unicode JSON string, not a byte string.
     if isinstance(data, unicode):
-      data = json.loads(data)
-      for name in ['rate', 'language', 'encoding', 'punctuation']:
-        if name in data and data[name] is not None:
-          setattr(self.transcriber, name, data[name])
+      data = _json.loads(data)
+      if data.get('rate') is not None:
+        self.transcriber.rate = data['rate']
+      if data.get('language') is not None:
+        self.transcriber.language = data['language']
+      if data.get('encoding') is not None:
+        self.transcriber.encoding = data['encoding']
+      if data.get('punctuation') is not None:
+        self.transcriber.punctuation = data['punctuation']
       logging.info('Connecting to API...')
       logging.info('Sample Rate: %d', self.transcriber.rate)
       logging.info('Encoding: %s', self.transcriber.encoding)
       logging.info('Language: %s', self.transcriber.language)
       logging.info('Punctuation: %s', self.transcriber.punctuation)
-      self.transcriber.start()
+      self._start_transcriber()
       return
 
-    # Ensure is started.
-    if not self.transcriber.is_started:
-      self._start_time = time.time()
-      self.transcriber.start()
+    # Ensure is started.  The transcriber only sets is_started once its
+    # thread is connected, so check the timeout, which is set on start.
+    if self._timeout_handle is None:
+      self._start_transcriber()
+
+    # Skip most silent audio, measured with audioop's C implementation.
+    # audioop needs whole 16-bit samples, so odd length chunks are sent as is.
+    if (self._skip_silence and len(data) % 2 == 0 and
+        audioop.rms(data, 2) < SILENCE_THRESHOLD):
+      now = time.time()
+      if now - self._silence_sent_time < SILENCE_KEEPALIVE_SECS:
+        return
+      self._silence_sent_time = now
 
     # Transcribe binary data.
     self._log_stream()
@@ -152,80 +214,151 @@ class SpeechHandler(websocket.WebSocketHandler):
   def on_transcribing(self, recorded_audio_data):
     """Logs an outgoing data stream to the Speech API.
 
+    This is called from the transcriber thread, so the chunk is logged and
+    recorded on the IOLoop by _on_audio_sent.  Otherwise, the recording could
+    be resized while being written to a file in on_close.  Outside of
+    development, there is nothing to do.
+
     Args:
       recorded_audio_data: A chunk of binary audio data in LINEAR16 format.
     """
-    self._log_stream(True)
-
-    # Debug: Record audio files
-    if self.request.host == 'localhost:%i' % get_port():
-      self._recorded_audio_data.append(recorded_audio_data)
+    if is_dev() or self._is_local:
+      self._io_loop.add_callback(self._on_audio_sent, recorded_audio_data)
 
   def on_transcribed(self, result):
     """Returns the transcribed result from the Cloud Speech API.
 
-    The result is logged, and send to the client as serialized JSON.
+    The result is logged, serialized as JSON, and queued to be sent to the
+    client.  Queued results are sent in batches by _flush, except final results
+    which are flushed immediately to preserve their latency.  This is called
+    from the transcriber thread, so the immediate flush and any logging are
+    scheduled on the IOLoop rather than run directly.
 
     Args:
       result: A named tuple with fields 'text' and 'is_final'.  text is the
           transcribed text or a best guess, and is_final indicates that the
           phrase utterance is complete.
     """
-    self._log_columns = 0
-    if is_dev():
-      sys.stdout.write('\n')
-      logging.info('Transcribed Text: %s', result.text)
+    if is_dev() and self._io_loop:
+      self._io_loop.add_callback(self._log_result, result)
     if result and result.text:
-      self.write_message(
-          json.dumps({
-              'text': result.text,
-              'isFinal': result.is_final
-          }))
+      self._out_queue.append(RESULT_TEMPLATE % (
+          encode_basestring_ascii(result.text),
+          'true' if result.is_final else 'false'))
+      if result.is_final and self._io_loop:
+        self._io_loop.add_callback(self._flush)
 
   def on_close(self):
-    """Removes client id when websocket connection is closed."""
+    """Removes client when websocket connection is closed."""
     logging.info('Client Disconnected')
     self.transcriber.stop()
-    if self.id in _clients:
-      del _clients[self.id]
+    if is_dev():
+      self._flush_log_stream()
+    if self._flush_cb:
+      self._flush_cb.stop()
+    if self._timeout_handle:
+      self._io_loop.remove_timeout(self._timeout_handle)
+      self._timeout_handle = None
+    _clients.discard(self)
 
     # Record audio if running locally
-    if self.request.host == 'localhost:%i' % get_port():
+    if self._is_local:
       self._record_audio_files()
 
   def check_origin(self, _):
     """Allows cross-origin websocket requests."""
     return True
 
+  def get_compression_options(self):
+    """Disables compression, which only costs CPU for raw audio data."""
+    return None
+
+  def _start_transcriber(self):
+    """Starts the transcriber, and closes the connection after TIMEOUT."""
+    self._skip_silence = bool(SILENCE_THRESHOLD) and (
+        self.transcriber.encoding in transcriber.LINEAR16_ENCODINGS)
+    self.transcriber.start()
+    if self._timeout_handle is None:
+      self._timeout_handle = self._io_loop.call_later(TIMEOUT, self._on_timeout)
+
+  def _on_timeout(self):
+    """Closes the connection once TIMEOUT has elapsed."""
+    logging.info('Timeout... Closing socket')
+    self._timeout_handle = None
+    self.close()
+
+  def _log_result(self, result):
+    """Logs a transcribed result below the audio stream."""
+    self._flush_log_stream()
+    logging.info('Transcribed Text: %s', result.text)
+
+  def _on_audio_sent(self, recorded_audio_data):
+    """Logs and records a chunk of audio sent to the Speech API.
+
+    Args:
+      recorded_audio_data: A chunk of binary audio data in LINEAR16 format.
+    """
+    self._log_stream(True)
+
+    # Debug: Record audio files
+    if self._is_local:
+      self._recorded_audio_data.extend(recorded_audio_data)
+
+  def _flush(self):
+    """Sends all queued results to the client as a single JSON array."""
+    if not self._out_queue or self.ws_connection is None:
+      return
+    results = []
+    while self._out_queue:
+      results.append(self._out_queue.popleft())
+    self.write_message('[%s]' % ','.join(results))
+
   def _log_stream(self, output=False):
     """Displays the audio input/output stream to the console.
 
     This provides a simple way to visualize the input/output streams, and to
-    ensure the streams are roughly in sync.
+    ensure the streams are roughly in sync.  Characters are buffered and
+    written a full line at a time, rather than once per chunk.  This must only
+    be called on the IOLoop, since the buffer is not locked.  Outside of
+    development, this is replaced with a no-op.
 
     Args:
       output: An optional boolean to indicate output "O" rather than input "I".
     """
-    if is_dev():
-      if self._log_columns > 80:
-        self._log_columns = 0
-        sys.stdout.write('\n')
-      sys.stdout.write('O' if output else 'I')
-      self._log_columns += 1
+    self._log_line += 'O' if output else 'I'
+    if len(self._log_line) >= 80:
+      self._flush_log_stream()
+
+  def _flush_log_stream(self):
+    """Writes any buffered characters from _log_stream as a line."""
+    if self._log_line:
+      line, self._log_line = self._log_line, ''
+      sys.stdout.write(line + '\n')
 
   def _record_audio_files(self):
-    """Debug: Records a raw data file and a wav file."""
-    binary_data = ''.join(self._recorded_audio_data)
+    """Debug: Records a wav file, and a raw data file if DUMP_RAW is set."""
+    binary_data = memoryview(self._recorded_audio_data)
     if not os.path.exists('recordings'):
       os.makedirs('recordings')
-    path = 'recordings/audio-{}'.format(self.id)
+    path = 'recordings/audio-{}'.format(self._id)
+
+    # The frame count is known up front, so the header is written once.
     wav = wave.open(path + '.wav', 'wb')
-    wav.setparams((1, 2, self.transcriber.rate, 0, 'NONE', 'not compressed'))
-    wav.writeframes(binary_data)
+    wav.setparams((1, 2, self.transcriber.rate, len(binary_data) // 2, 'NONE',
+                   'not compressed'))
+    wav.writeframesraw(binary_data)
     wav.close()
-    raw = open(path + '.raw', 'wb')
-    raw.write(binary_data)
-    raw.close()
+
+    # The wav file already holds the same PCM data after its header.
+    if 'DUMP_RAW' in os.environ:
+      raw = open(path + '.raw', 'wb')
+      raw.write(binary_data)
+      raw.close()
+
+
+# The stream is only displayed in development, so skip the call otherwise.
+if not _IS_DEV:
+  SpeechHandler._log_stream = lambda self, output=False: None
 
 
 class CORSHandler(web.RequestHandler):
@@ -274,6 +407,25 @@ def get_port():
     return PORT
 
 
+def get_ssl_context():
+  """Returns the SSL context used for all HTTPS/WSS connections.
+
+  The certificate is loaded once, and the context is shared by every
+  connection.  Kernel TLS is enabled when supported by Python and OpenSSL.
+
+  Returns:
+    An ssl.SSLContext for the server.
+  """
+  cert_name = ('localhost' if is_dev() else 'prod')
+  context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+  context.load_cert_chain('.private/%s.crt' % cert_name,
+                          '.private/%s.key' % cert_name)
+  context.set_ciphers(SSL_CIPHERS)
+  context.options |= ssl.OP_NO_COMPRESSION
+  context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+  return context
+
+
 def is_dev():
   """Returns true if run in a local development environment.
 
@@ -282,7 +434,7 @@ def is_dev():
   Returns:
     A boolean indicating is development.
   """
-  return 'IS_DEVELOPMENT' in os.environ
+  return _IS_DEV
 
 
 if __name__ == '__main__':
@@ -300,13 +452,7 @@ if __name__ == '__main__':
   ])
 
   # HTTPS/WSS handler
-  cert_name = ('localhost' if is_dev() else 'prod')
-  app.listen(
-      get_port(),
-      ssl_options={
-          'certfile': '.private/%s.crt' % cert_name,
-          'keyfile': '.private/%s.key' % cert_name,
-      })
+  app.listen(get_port(), ssl_options=get_ssl_context())
   logging.info('Secure libs listening on port %s', get_port())
 
   # Start libs loop
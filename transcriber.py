@@ -25,13 +25,16 @@ located at ".private/credentials.json".
 from __future__ import absolute_import
 
 import collections
+import itertools
 import json
+import logging
 import os
-import Queue
 import threading
+import time
 
 import gcloud.credentials
 import grpc
+import httplib2
 from oauth2client import service_account
 
 from google.cloud import speech_v1p1beta1 as cloud_speech
@@ -48,11 +51,46 @@ from google.rpc import code_pb2
 # Note: This is the suggest from docs and sample code
 TIMEOUT_SECS = 8 * 60 * 60
 
+# Values of the encoding attribute that mean LINEAR16 audio, as an enum or as
+# the name sent in a client's config.
+LINEAR16_ENCODINGS = (enums.RecognitionConfig.AudioEncoding.LINEAR16,
+                      'LINEAR16')
+
 SPEECH_SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
 API_HOST = 'speech.googleapis.com'
 API_PORT = 443
 CREDS_PATH = '.private/credentials.json'
 
+# Queued audio chunks are joined into a single request of up to this many
+# bytes, collected for no longer than BATCH_SECS.  This reduces the number of
+# requests sent to the Speech API.
+BATCH_SIZE = 16000
+BATCH_SECS = .1
+
+# Maximum seconds of 16-bit mono audio held while waiting to be sent to the
+# Speech API, at the transcriber's sample rate.  Once full, the oldest chunks
+# are dropped to make room for new ones, so memory stays bounded if the API
+# falls behind.
+MAX_QUEUED_SECS = 30
+
+# Number of channels to the Speech API shared by all transcribers.  Each
+# channel multiplexes many streams over one HTTP/2 connection.
+CHANNEL_POOL_SIZE = 4
+
+# Pool of channels, created on first use and returned round-robin.
+_channels = []
+_channel_counter = itertools.count()
+_channel_lock = threading.Lock()
+
+# Access tokens are refreshed in the background this many seconds before they
+# expire, but no more often than every TOKEN_MIN_REFRESH_SECS.
+TOKEN_REFRESH_MARGIN_SECS = 5 * 60
+TOKEN_MIN_REFRESH_SECS = 60
+
+# Credentials, loaded on first use and shared by all channels.
+_credentials = None
+_credentials_lock = threading.Lock()
+
 
 # The result passed to the on_transcribed callback.
 TranscribedResult = collections.namedtuple('TranscribedResult', 'text is_final')
@@ -77,7 +115,8 @@ class Transcriber(threading.Thread):
     on_connected: An optional callback ran after a channel is connected
         and authorized.  No arguments are passed to callback.
     on_transcribing: An optional callback ran after audio data is sent to
-        the Speech API.   The raw audio data is passed to the callback.
+        the Speech API.   It runs once for each chunk of raw audio data in a
+        request, and the chunk is passed to the callback.
     on_transcribed: An optional callback ran after text is returned from
         the Speech API.  A TranscribedResult object with the properties
         text and is_final is passed to the callback.
@@ -85,6 +124,8 @@ class Transcriber(threading.Thread):
     is_connected: A boolean indicating that the connection is open.
     is_started: A boolean indicating that audio is being transcribed.
     timeout_secs: The number of seconds before he connection is closed.
+    batch_size: The maximum number of bytes of queued audio sent in a single
+        request.  Use 0 to send each chunk as it is received.
   """
 
   def __init__(
@@ -98,7 +139,8 @@ class Transcriber(threading.Thread):
       on_connected=None,
       on_transcribing=None,
       on_transcribed=None,
-      audio_stream=None):
+      audio_stream=None,
+      batch_size=BATCH_SIZE):
     """Initializes the default attributes for the class."""
 
     super(Transcriber, self).__init__()
@@ -106,7 +148,7 @@ class Transcriber(threading.Thread):
     # Represents a stream of audio bytes.
     # This can be mocked for testing
     if audio_stream is None:
-      self.audio_stream = QueuedAudioStream()
+      self.audio_stream = QueuedAudioStream(_max_queued_bytes(rate))
     else:
       self.audio_stream = audio_stream
 
@@ -117,6 +159,7 @@ class Transcriber(threading.Thread):
     self.rate = rate
     self.timeout_secs = timeout_secs
     self.interim_results = interim_results
+    self.batch_size = batch_size
 
     # Callbacks
     self.is_connected = False
@@ -146,8 +189,8 @@ class Transcriber(threading.Thread):
     if self._stop_event.is_set():
       return
 
-    # Create SSL channel.
-    channel = self._create_channel()
+    # Get a shared SSL channel.
+    channel = _get_channel()
     self.is_started = True
 
     # Open stream
@@ -181,6 +224,10 @@ class Transcriber(threading.Thread):
     else:
       self._thread_started = True
 
+    # The rate may have been configured since the stream was created.
+    if isinstance(self.audio_stream, QueuedAudioStream):
+      self.audio_stream.max_bytes = _max_queued_bytes(self.rate)
+
     # Start thread if stop event hasn't occurred.
     if not self._stop_event.is_set():
       super(Transcriber, self).start()
@@ -236,38 +283,54 @@ class Transcriber(threading.Thread):
     if self.on_connected:
       self.on_connected()
 
+    # A single request is reused for every chunk.  gRPC serializes each
+    # request before asking the generator for the next one, so it is safe to
+    # overwrite the audio content after yielding.
+    request = types.StreamingRecognizeRequest()
+
     with self.audio_stream as stream:
       while not self._stop_event.is_set():
-        data = stream.read()
-        if data:
-          # Run on_transcribing callback when sending to Speech API.
-          if self.on_transcribing:
-            self.on_transcribing(data)
-          yield types.StreamingRecognizeRequest(audio_content=data)
-
-  def _create_channel(self):
-    """Opens an SSL channel to the Speech API.
+        # Reading blocks for up to READ_WAIT_SECS while no audio is queued,
+        # so the loop doesn't spin while the client is idle.
+        chunks = self._read_batch(stream)
+        if not chunks:
+          continue
 
-    Returns:
-      A grpc.Channel
-    """
+        # Run on_transcribing callback for each chunk sent to Speech API.
+        if self.on_transcribing:
+          for chunk in chunks:
+            self.on_transcribing(chunk)
+        request.audio_content = b''.join(chunks)
+        yield request
 
-    # In order to make an https call, use an ssl channel with defaults.
-    ssl_channel = grpc.ssl_channel_credentials()
+  def _read_batch(self, stream):
+    """Reads queued audio chunks from the stream, to be sent as one request.
 
-    # Add a plugin to inject the creds into the header.
-    auth_header = (
-        'Authorization',
-        'Bearer ' + _get_credentials().get_access_token().access_token)
-    auth_plugin = grpc.metadata_call_credentials(
-        lambda _, cb: cb([auth_header], None), name='google_creds')
+    Chunks are read until the queue is empty, batch_size bytes are read, or
+    BATCH_SECS have elapsed.
 
-    # Compose the 2 together for both ssl and google auth.
-    composite_channel = grpc.composite_channel_credentials(ssl_channel,
-                                                           auth_plugin)
+    Args:
+      stream: The audio stream to read from.
 
-    return grpc.secure_channel('{}:{}'.format(API_HOST, API_PORT),
-                               composite_channel)
+    Returns:
+      A list of strings of audio bytes, empty if no data is available.
+    """
+    data = stream.read()
+    if not data:
+      return []
+    if self.batch_size <= 0:
+      return [data]
+
+    chunks = [data]
+    total = len(data)
+    deadline = time.time() + BATCH_SECS
+    while total < self.batch_size and time.time() < deadline:
+      data = stream.read()
+      if not data:
+        break
+      chunks.append(data)
+      total += len(data)
+    return chunks
 
 
 class QueuedAudioStream(object):
@@ -276,38 +339,191 @@ class QueuedAudioStream(object):
   This class acts as a buffer for a streaming audio source, such
   as incoming audio chunks recorded locally, and sent via websocket. This
   class is mockable to emulate incoming audio with a test file.
+
+  The buffer holds at most max_bytes bytes of audio.  When it is full, the
+  oldest chunks are dropped to make room for a new one.
+
+  Attributes:
+    max_bytes: The maximum number of bytes held, or None for no limit.
   """
 
   # We need to approximate incoming, real-time audio
   READ_WAIT_SECS = .010
 
-  def __init__(self):
-    # Used for storing incoming audio chunks.
-    self.queue = Queue.Queue()
+  def __init__(self, max_bytes=None):
+    self.max_bytes = max_bytes
+
+    # Used for storing incoming audio chunks, and their total size.  The lock
+    # keeps the size in step with the queue across the writer and reader
+    # threads.
+    self.queue = collections.deque()
+    self._queued_bytes = 0
+    self._lock = threading.Lock()
+
+    # Whether chunks are being dropped, so the warning is logged only once.
+    self._is_dropping = False
+
+    # Set when a chunk is written, so that read can block instead of polling.
+    self._data_event = threading.Event()
 
   def __enter__(self):
     return self
 
   def __exit__(self, *args):
-    with self.queue.mutex:
-      self.queue.queue.clear()
+    with self._lock:
+      self.queue.clear()
+      self._queued_bytes = 0
+
+    # Unblock a reader waiting on incoming data.
+    self._data_event.set()
 
   def __call__(self, *args):
     return self
 
   def write(self, data):
-    """Writes a chunk of audio data to Queue."""
-    self.queue.put(data)
+    """Writes a chunk of audio data, dropping the oldest chunks if full."""
+    with self._lock:
+      self.queue.append(data)
+      self._queued_bytes += len(data)
+      dropped = False
+      while self.max_bytes and self._queued_bytes > self.max_bytes:
+        self._queued_bytes -= len(self.queue.popleft())
+        dropped = True
+      if dropped and not self._is_dropping:
+        logging.warning('Audio queue is full, dropping oldest audio')
+      self._is_dropping = dropped
+    self._data_event.set()
 
   def read(self):
-    """Reads a chunk of audio bytes from the Queue."""
-    if not self.queue.empty():
-      data = self.queue.get(True, self.READ_WAIT_SECS)
-      if data:
-        return data
+    """Reads a chunk of audio bytes from the queue.
+
+    If the queue is empty, waits up to READ_WAIT_SECS for a chunk to be
+    written.
+
+    Returns:
+      A chunk of audio bytes, or None if no data is available.
+    """
+    if not self.queue:
+      # Clear before checking again so a concurrent write isn't missed.
+      self._data_event.clear()
+      if not self.queue:
+        self._data_event.wait(self.READ_WAIT_SECS)
+    with self._lock:
+      if not self.queue:
+        return None
+      data = self.queue.popleft()
+      self._queued_bytes -= len(data)
+      return data
+
+
+def _max_queued_bytes(rate):
+  """Returns the size of MAX_QUEUED_SECS of 16-bit mono audio.
+
+  Args:
+    rate: An int representing sample rate in Hertz of the audio.
+
+  Returns:
+    An int number of bytes.
+  """
+  return MAX_QUEUED_SECS * rate * 2
+
+
+def _get_channel():
+  """Returns an SSL channel to the Speech API from the shared pool.
+
+  The pool is filled on first use, and channels are returned round-robin so
+  that streams are spread across connections.
+
+  Returns:
+    A grpc.Channel
+  """
+  with _channel_lock:
+    if not _channels:
+      _channels.extend(_create_channel() for _ in range(CHANNEL_POOL_SIZE))
+    return _channels[next(_channel_counter) % len(_channels)]
+
+
+def _create_channel():
+  """Opens an SSL channel to the Speech API.
+
+  Returns:
+    A grpc.Channel
+  """
+
+  # In order to make an https call, use an ssl channel with defaults.
+  ssl_channel = grpc.ssl_channel_credentials()
+
+  # Add a plugin to inject the creds into the header.  The token is looked up
+  # for each call, since the channel outlives any single access token.
+  auth_plugin = grpc.metadata_call_credentials(
+      lambda _, cb: cb([('Authorization', 'Bearer ' + _get_access_token())],
+                       None),
+      name='google_creds')
+
+  # Compose the 2 together for both ssl and google auth.
+  composite_channel = grpc.composite_channel_credentials(ssl_channel,
+                                                         auth_plugin)
+
+  return grpc.secure_channel('{}:{}'.format(API_HOST, API_PORT),
+                             composite_channel)
+
+
+def _get_access_token():
+  """Returns the current OAuth access token.
+
+  The token is kept fresh by a background thread, so this only makes a
+  request if the token is missing or has expired anyway.
+
+  Returns:
+    A string containing the access token.
+  """
+  return _get_credentials().get_access_token().access_token
 
 
 def _get_credentials():
+  """Returns the credentials shared by all channels.
+
+  The credentials are loaded, and the first access token fetched, on the
+  first call while holding the lock, so concurrent callers never fetch a
+  token at the same time.  This also starts a daemon thread that refreshes
+  the access token before it expires.
+
+  Returns:
+    oauth2client.service_account.ServiceAccountCredentials
+  """
+  global _credentials
+  with _credentials_lock:
+    if _credentials is None:
+      creds = _load_credentials()
+      expires_in = creds.get_access_token().expires_in
+      refresher = threading.Thread(
+          target=_refresh_credentials, args=(creds, expires_in))
+      refresher.daemon = True
+      refresher.start()
+      _credentials = creds
+    return _credentials
+
+
+def _refresh_credentials(creds, expires_in):
+  """Refreshes the access token shortly before it expires, forever.
+
+  Args:
+    creds: The credentials to keep refreshed.
+    expires_in: The number of seconds until the current token expires.
+  """
+  while True:
+    time.sleep(max(TOKEN_MIN_REFRESH_SECS,
+                   (expires_in or 0) - TOKEN_REFRESH_MARGIN_SECS))
+    try:
+      creds.refresh(httplib2.Http())
+      # The token was just refreshed, so this doesn't make a request.
+      expires_in = creds.get_access_token().expires_in
+    except Exception:
+      logging.exception('Failed to refresh access token')
+      expires_in = 0
+
+
+def _load_credentials():
   """Retrieves the credentials for oAuth authentication.
 
   First, the existence of a credentials.json file is checked. If it is not